@@ -4,6 +4,15 @@ import json
 import multiprocessing
 import os
 
+from uvicorn.workers import UvicornWorker
+
+
+class PixelsWorker(UvicornWorker):
+    """Uvicorn worker pinned to the uvloop event loop and the httptools HTTP parser."""
+
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
 use_max_workers = int(os.getenv("MAX_WORKERS", "0"))
 web_concurrency = int(os.getenv("WEB_CONCURRENCY", "0"))
 workers_per_core = float(os.getenv("WORKERS_PER_CORE", "1"))
@@ -18,6 +27,7 @@ bind = os.getenv("BIND") or f"{host}:{port}"
 
 # Gunicorn config variables
 workers = web_concurrency
+worker_class = PixelsWorker
 
 loglevel = os.getenv("LOG_LEVEL", "info")
 errorlog = os.getenv("ERROR_LOG")
@@ -27,6 +37,10 @@ graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "120"))
 timeout = int(os.getenv("TIMEOUT", "120"))
 keepalive = int(os.getenv("KEEP_ALIVE", "5"))
 
+# Each worker opens its own Postgres pool, this must stay below the server's max_connections
+max_pool_size = int(os.getenv("MAX_POOL_SIZE", "5"))
+db_connections = workers * max_pool_size
+
 # For debugging and testing
 log_data = {
     "loglevel": loglevel,
@@ -42,5 +56,6 @@ log_data = {
     "use_max_workers": use_max_workers,
     "host": host,
     "port": port,
+    "db_connections": db_connections,
 }
 print(json.dumps(log_data))
@@ -3,10 +3,10 @@ import logging
 from pixels.pixels import app  # noqa: F401 Unused import
 
 
-ENDPOINTS_TO_FILTER_OUT = (
-    "/set_pixel",
-    "/get_size"
-)
+ENDPOINTS_TO_FILTER_OUT = frozenset({
+    ("PUT", "/canvas/pixel"),
+    ("GET", "/canvas/size"),
+})
 
 
 class EndpointFilter(logging.Filter):
@@ -14,8 +14,11 @@ class EndpointFilter(logging.Filter):
 
     def filter(self, record: logging.LogRecord) -> bool:
         """Returns true for logs that don't contain anything we want to filter out."""
-        log = record.getMessage()
-        return all(endpoint not in log for endpoint in ENDPOINTS_TO_FILTER_OUT)
+        # uvicorn passes the method and path as arguments, so they're checked without formatting the message
+        if not isinstance(record.args, tuple) or len(record.args) < 3:
+            return True
+        _, method, path, *_ = record.args
+        return (method, path.partition("?")[0]) not in ENDPOINTS_TO_FILTER_OUT
 
 
 # Filter out all endpoints in `ENDPOINTS_TO_FILTER_OUT`
@@ -1,8 +1,14 @@
 import asyncio
+import gzip
+import io
 import logging
-from time import time
+import struct
+import typing as t
+import uuid
+from time import monotonic, time
 
 from aioredis import Redis
+from aioredis.commands import Pipeline
 from asyncpg import Connection
 
 from pixels.constants import Server, Sizes
@@ -10,9 +16,43 @@ from pixels.constants import Server, Sizes
 log = logging.getLogger(__name__)
 
 
+# Redis keys, namespaced by the deployed commit so a new layout never reads an old one
+CACHE_KEY = f"{Server.GIT_SHA}-canvas-cache"
+# A hash of a random epoch, replaced on every rebuild, and of a counter bumped on every write
+VERSION_KEY = f"{Server.GIT_SHA}-canvas-snapshot-version"
+SYNC_LOCK_KEY = f"{Server.GIT_SHA}-canvas-sync-lock"
+
 # How long before considering that the key is deadlocked and won't be released
 KEY_TIMEOUT = 10
 
+# Deletes the sync lock only if it still holds the token of the worker releasing it
+RELEASE_LOCK_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+"""
+
+# How long a worker trusts a successful sync before checking the cache state in the database again
+SYNC_CHECK_INTERVAL = 0.25
+
+# Rows of the binary COPY used to rebuild the cache: field count, then the length and value of
+# the int4 byte offset and of the 3 bytes long bytea colour
+COPY_ROW = struct.Struct("!hiii3s")
+
+
+def _build_cache(copy_data: memoryview) -> bytearray:
+    """Build the canvas cache out of the binary COPY output of the cache rebuild query."""
+    cache = bytearray(Sizes.WIDTH * Sizes.HEIGHT * 3)
+
+    # The stream is an 11 bytes signature, the flags, a header extension and a 2 bytes trailer around the rows
+    rows_start = 19 + int.from_bytes(copy_data[15:19], "big")
+    with memoryview(cache) as view:
+        for _, _, position, _, rgb in COPY_ROW.iter_unpack(copy_data[rows_start:-2]):
+            view[position:position + 3] = rgb
+
+    return cache
+
 
 class Canvas:
     """Class used for interacting with the canvas."""
@@ -20,51 +60,88 @@ class Canvas:
     def __init__(self, redis: Redis):
         self.redis = redis
 
+        # Local copy of the whole board, valid as long as the version stored in redis doesn't change
+        self._snapshot: t.Optional[bytes] = None
+        self._snapshot_version: t.Optional[str] = None
+        # Gzip compressed copy of `_snapshot`, built the first time it is requested
+        self._compressed_snapshot: t.Optional[bytes] = None
+
+        # When this worker last saw the cache up-to-date, see SYNC_CHECK_INTERVAL
+        self._last_sync_check = -SYNC_CHECK_INTERVAL
+        self._sync_lock = asyncio.Lock()
+
+    @property
+    def snapshot_version(self) -> t.Optional[str]:
+        """
+        The version of the board last returned by `get_pixels`, if the board was ever written.
+
+        It is made of the deployed commit, the epoch of the last rebuild and the write counter. The counter alone
+        starts over whenever redis is flushed or a new commit is deployed, so it could repeat for another board.
+        """
+        return self._snapshot_version
+
     @staticmethod
-    async def _try_acquire_lock(conn: Connection) -> bool:
+    def _bump_version(pipe: Pipeline) -> None:
         """
-        Try to acquire the sync lock from the cache state.
+        Mark every snapshot of the board as stale, this must be queued with any write to the cache.
 
-        Returns True if the lock has been acquired. The lock functions as a spinlock.
+        The bump is queued on the pipeline of the write, so both are sent in a single round trip.
         """
-        # We try to set the lock but use a self join to return the previous state.
-        previous_record, = await conn.fetch(
-            "UPDATE cache_state x "
-            "SET sync_lock = now() "
-            "FROM ( "
-            "   SELECT sync_lock FROM cache_state "
-            "   FOR UPDATE "
-            ") y "
-            "RETURNING y.sync_lock AS previous_state"
-        )
-        return previous_record["previous_state"] is None
+        pipe.hincrby(VERSION_KEY, "counter", 1)
+
+    async def _try_acquire_lock(self) -> t.Optional[str]:
+        """
+        Try to acquire the sync lock shared by all the workers.
+
+        Returns the token of the lock if it has been acquired, which is needed to release it.
+        The lock expires by itself after KEY_TIMEOUT seconds,
+        so a worker dying while holding it can't deadlock the others.
+        """
+        token = uuid.uuid4().hex
+        acquired = await self.redis.set(SYNC_LOCK_KEY, token, expire=KEY_TIMEOUT, exist=self.redis.SET_IF_NOT_EXIST)
+        return token if acquired else None
+
+    async def _release_lock(self, token: str) -> None:
+        """Release the sync lock, unless it expired and was taken by another worker in the meantime."""
+        await self.redis.eval(RELEASE_LOCK_SCRIPT, keys=[SYNC_LOCK_KEY], args=[token])
 
     async def _populate_cache(self, conn: Connection) -> None:
         """Populate the cache and discard old values."""
         start_time = time()
 
-        cache = bytearray(Sizes.WIDTH * Sizes.HEIGHT * 3)
+        # Postgres computes the offset and decodes the colour, leaving a single slice assignment per pixel here.
+        # x and y are int2 columns, the offset must be computed in int4 as it doesn't fit in a smallint.
+        sql = (
+            "SELECT (y::int4 * $1::int4 + x) * 3, decode(rgb, 'hex') "
+            "FROM current_pixel WHERE x < $1::int4 AND y < $2::int4"
+        )
 
-        sql = "SELECT x, y, rgb FROM current_pixel WHERE x < $1 AND y < $2"
+        # A binary COPY skips building a Record for every row, each row is unpacked straight from the stream
+        stream = io.BytesIO()
+        await conn.copy_from_query(sql, Sizes.WIDTH, Sizes.HEIGHT, output=stream, format="binary")
 
-        records = await conn.fetch(sql, Sizes.WIDTH, Sizes.HEIGHT)
-        for record in records:
-            position = record["y"] * Sizes.WIDTH + record["x"]
-            cache[position * 3:(position + 1) * 3] = bytes.fromhex(record["rgb"])
+        # Filling the cache is the only CPU heavy part of a sync, it runs in a thread so requests are still served
+        with stream.getbuffer() as data:
+            cache = await asyncio.get_running_loop().run_in_executor(None, _build_cache, data)
 
-        await self.redis.set(f"{Server.GIT_SHA}-canvas-cache", cache)
+        pipe = self.redis.pipeline()
+        pipe.set(CACHE_KEY, cache)
+        pipe.hset(VERSION_KEY, "epoch", uuid.uuid4().hex)
+        self._bump_version(pipe)
+        await pipe.execute()
 
         log.info(f"Cache updated finished! (took {time() - start_time}s)")
-        await conn.execute("UPDATE cache_state SET last_synced = now()")
+        await conn.statements["mark_synced"].fetch()
 
     async def is_cache_out_of_date(self, conn: Connection) -> bool:
         """Return true if the cache can be considered out of date."""
-        cache = await self.get_pixels()
-        if not cache or len(cache)//3 != Sizes.WIDTH*Sizes.HEIGHT:
+        # STRLEN is enough to check the size, without downloading the whole board
+        cache_size = await self.redis.strlen(CACHE_KEY)
+        if cache_size != Sizes.WIDTH * Sizes.HEIGHT * 3:
             # Canvas size has changed, force a cache refresh
             return True
 
-        record, = await conn.fetch("SELECT last_modified, last_synced FROM cache_state")
+        record = await conn.statements["cache_state"].fetchrow()
         return record["last_modified"] > record["last_synced"]
 
     async def sync_cache(self, conn: Connection, *, skip_check: bool = False) -> None:
@@ -73,46 +150,34 @@ class Canvas:
 
         `skip_check` is used when you want to force a canvas refresh, ignoring the
         stored cache state in the db.
+        Without `skip_check`, the check itself is skipped if the cache was seen up-to-date very recently.
         """
-        lock_cleared = False
-
-        while skip_check or await self.is_cache_out_of_date(conn):
-            log.info("Cache will be updated")
-
-            if await self._try_acquire_lock(conn) or lock_cleared:
-                log.info("Lock acquired. Starting synchronisation.")
-                lock_cleared = False
-                skip_check = False  # Don't infinite loop after refreshing cache.
-                try:
-                    await self._populate_cache(conn)
-                # Use a finally block to make sure that the lock is freed
-                finally:
-                    await conn.execute("UPDATE cache_state SET sync_lock = NULL")
+        # Only one request per worker runs the check, the others wait for its outcome
+        async with self._sync_lock:
+            if not skip_check and monotonic() - self._last_sync_check < SYNC_CHECK_INTERVAL:
+                return
+
+            while skip_check or await self.is_cache_out_of_date(conn):
+                log.info("Cache will be updated")
+
+                if token := await self._try_acquire_lock():
+                    log.info("Lock acquired. Starting synchronisation.")
+                    skip_check = False  # Don't infinite loop after refreshing cache.
+                    try:
+                        await self._populate_cache(conn)
+                    # Use a finally block to make sure that the lock is freed
+                    finally:
+                        await self._release_lock(token)
+                else:
+                    # Another process is already syncing the cache, let's just wait patiently.
+                    log.info("Lock in use. Waiting for process to be finished")
+
+                    while await self.redis.exists(SYNC_LOCK_KEY):
+                        await asyncio.sleep(.1)
             else:
-                # Another process is already syncing the cache, let's just wait patiently.
-                log.info("Lock in use. Waiting for process to be finished")
-
-                while True:
-                    record, = await conn.fetch("SELECT sync_lock FROM cache_state")
-
-                    if record["sync_lock"] is None:
-                        break
-
-                    # If it has been too long since the lock has been set
-                    # we consider it as deadlocked and clear it
-                    result = await conn.execute(
-                        "UPDATE cache_state SET sync_lock = now() "
-                        f"WHERE now() - sync_lock > interval '{KEY_TIMEOUT} seconds'"
-                    )
-                    if result.split()[1] == "1":
-                        log.warning("Lock considered as deadlocked. Clearing it.")
-                        await conn.execute("UPDATE cache_state SET sync_lock = now()")
-                        lock_cleared = True
-                        break
-
-                    await asyncio.sleep(.1)
-        else:
-            log.debug("Cache is up-to-date")
+                log.debug("Cache is up-to-date")
+
+            self._last_sync_check = monotonic()
 
     async def set_pixel(self, conn: Connection, x: int, y: int, rgb: str, user_id: int) -> None:
         """Set the provided pixel."""
@@ -120,27 +185,62 @@ class Canvas:
 
         async with conn.transaction():
             # Insert the pixel into the database
-            await conn.execute(
-                "INSERT INTO pixel_history (x, y, rgb, user_id, deleted) "
-                "VALUES ($1, $2, $3, $4, false)",
-                x,
-                y,
-                rgb,
-                user_id
-            )
+            await conn.statements["insert_pixel"].fetch(x, y, rgb, user_id)
 
             # Update the cache
             position = (y * Sizes.WIDTH + x) * 3
-            await self.redis.setrange(f"{Server.GIT_SHA}-canvas-cache", position, bytes.fromhex(rgb))
+            pipe = self.redis.pipeline()
+            pipe.setrange(CACHE_KEY, position, bytes.fromhex(rgb))
+            self._bump_version(pipe)
+            await pipe.execute()
+
+            await conn.statements["mark_synced"].fetch()
 
-            await conn.execute("UPDATE cache_state SET last_synced = now()")
+    async def _current_version(self) -> t.Optional[str]:
+        """Return the version of the board currently stored in redis, or None if it isn't known."""
+        epoch, counter = await self.redis.hmget(VERSION_KEY, "epoch", "counter")
+        if epoch is None or counter is None:
+            return None
+        return f"{Server.GIT_SHA}-{epoch.decode('ascii')}-{counter.decode('ascii')}"
 
     async def get_pixels(self) -> bytes:
-        """Returns the whole board."""
-        canvas = await self.redis.get(f"{Server.GIT_SHA}-canvas-cache")
-        return bytes(canvas) if canvas else None
+        """
+        Returns the whole board.
+
+        The board is only fetched from redis when its version changed since the last call,
+        otherwise the same immutable snapshot is returned.
+        """
+        version = await self._current_version()
+        if version is not None and version == self._snapshot_version:
+            return self._snapshot
+
+        canvas = await self.redis.get(CACHE_KEY)
+        if not canvas:
+            return None
+
+        # aioredis already returns an immutable bytes object, so it can be shared between requests as is.
+        # The version is read first, so a write happening in between only causes an extra refresh later.
+        self._snapshot = canvas
+        self._snapshot_version = version
+        self._compressed_snapshot = None
+        return self._snapshot
+
+    async def get_compressed_pixels(self) -> t.Optional[bytes]:
+        """
+        Returns the whole board, gzip compressed.
+
+        The board is compressed once per version, rather than once per response.
+        """
+        snapshot = await self.get_pixels()
+        if snapshot is None:
+            return None
+
+        # get_pixels clears the compressed copy whenever it refreshes the snapshot
+        if self._compressed_snapshot is None:
+            self._compressed_snapshot = gzip.compress(snapshot, compresslevel=6)
+        return self._compressed_snapshot
 
-    async def get_pixel(self, x: int, y: int) -> bytearray:
+    async def get_pixel(self, x: int, y: int) -> bytes:
         """Returns a single pixel from the board."""
         position = (y * Sizes.WIDTH + x) * 3
-        return await self.redis.getrange(f"{Server.GIT_SHA}-canvas-cache", position, position+2)
+        return await self.redis.getrange(CACHE_KEY, position, position+2)
@@ -7,6 +7,8 @@ from decouple import config
 from fastapi import Query
 from fastapi.templating import Jinja2Templates
 
+from pixels.utils.database import PixelsConnection, prepare_statements
+
 
 class Connections:
     """How to connect to other, internal services."""
@@ -14,11 +16,21 @@ class Connections:
     DATABASE_URL = config("DATABASE_URL")
     REDIS_URL = config("REDIS_URL")
 
+    # Connections per worker, the total is this multiplied by the number of gunicorn workers
+    MAX_POOL_SIZE = config("MAX_POOL_SIZE", cast=int, default=5)
+
     # Awaited in application startup
     DB_POOL = asyncpg.create_pool(
         DATABASE_URL,
-        min_size=config("MIN_POOL_SIZE", cast=int, default=2),
-        max_size=config("MAX_POOL_SIZE", cast=int, default=5)
+        # Open every connection upfront so that bursts of requests don't wait on new connections
+        min_size=config("MIN_POOL_SIZE", cast=int, default=MAX_POOL_SIZE),
+        max_size=MAX_POOL_SIZE,
+        # Cache the parsed statements of each connection, most of our queries are the same few strings
+        statement_cache_size=config("STATEMENT_CACHE_SIZE", cast=int, default=1024),
+        connection_class=PixelsConnection,
+        init=prepare_statements,
+        # Our queries are all short, compiling them with LLVM costs more than it ever saves
+        server_settings={"jit": "off"},
     )
     # Result set during application startup
     REDIS_FUTURE = asyncio.Future()
@@ -43,6 +55,12 @@ class Authorization:
     ACCESS_EXPIRES_IN = 3600
     REFRESH_EXPIRES_IN = ACCESS_EXPIRES_IN * 6  # 6 access token lifetimes
 
+    # How long a worker trusts a verified access token before checking the database again
+    CACHE_TTL = 60
+    # Banned users are only cached briefly, unknown users are never cached
+    CACHE_FAILURE_TTL = 5
+    CACHE_MAX_SIZE = 10_000
+
 
 class Server:
     """General config for the pixels server."""
@@ -61,8 +79,9 @@ class Server:
     LOG_LEVEL = config("LOG_LEVEL", default="INFO")
     SHOW_DEV_ENDPOINTS = "true" != config("PRODUCTION", default="false")
 
+    # Read once per worker at import, a set as it is only used for membership checks
     with open("pixels/resources/mods.txt") as f:
-        MODS = f.read().split()
+        MODS = frozenset(f.read().split())
 
     TEMPLATES = Jinja2Templates(directory="pixels/templates")
 
@@ -3,9 +3,9 @@ import traceback
 
 from fastapi import APIRouter, Cookie, HTTPException, Request, Response
 from httpx import AsyncClient
-from starlette.responses import RedirectResponse
+from starlette.responses import HTMLResponse, RedirectResponse
 
-from pixels.constants import Authorization, Discord, Server
+from pixels.constants import Authorization, Connections, Discord, Server
 from pixels.models import AccessToken, RefreshToken
 from pixels.utils import auth
 
@@ -23,31 +23,35 @@ async def authorize() -> Response:
     return RedirectResponse(url=Discord.AUTH_URL)
 
 
+# Neither page depends on the request, so the templates are loaded once instead of on every hit,
+# and the page without a token is rendered once.
+_API_TOKEN_TEMPLATE = Server.TEMPLATES.get_template("api_token.html")
+_COOKIE_DISABLED_PAGE = Server.TEMPLATES.get_template("cookie_disabled.html").render()
+
+
 @router.get("/show_token")
-async def show_token(request: Request, token: str = Cookie(None)) -> Response:  # noqa: B008
+async def show_token(token: str = Cookie(None)) -> Response:  # noqa: B008
     """Show the refresh token from the URL path to the user."""
-    template_name = "cookie_disabled.html"
-    context = {"request": request}
-
     if token:
-        context["token"] = token
-        template_name = "api_token.html"
+        return HTMLResponse(_API_TOKEN_TEMPLATE.render(token=token))
 
-    return Server.TEMPLATES.TemplateResponse(template_name, context)
+    return HTMLResponse(_COOKIE_DISABLED_PAGE)
+
+
+# Only the code changes between token requests
+_OAUTH_TOKEN_QUERY = {
+    "client_id": Discord.CLIENT_ID,
+    "client_secret": Discord.CLIENT_SECRET,
+    "grant_type": "authorization_code",
+    "redirect_uri": f"{Server.BASE_URL}/callback",
+    "scope": "identify",
+}
+_OAUTH_TOKEN_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
 
 def build_oauth_token_request(code: str) -> tuple[dict, dict]:
     """Given a code, return a dict of query params needed to complete the OAuth2 flow."""
-    query = {
-        "client_id": Discord.CLIENT_ID,
-        "client_secret": Discord.CLIENT_SECRET,
-        "grant_type": "authorization_code",
-        "code": code,
-        "redirect_uri": f"{Server.BASE_URL}/callback",
-        "scope": "identify",
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    return query, headers
+    return {**_OAUTH_TOKEN_QUERY, "code": code}, _OAUTH_TOKEN_HEADERS
 
 
 @router.get("/callback")
@@ -57,13 +61,15 @@ async def auth_callback(request: Request) -> Response:
 
     This endpoint is only used as a redirect target from Discord.
     """
+    client: AsyncClient = request.app.state.http_client
     try:
-        async with AsyncClient() as client:
-            token_params, token_headers = build_oauth_token_request(request.query_params["code"])
-            auth_token = (await client.post(Discord.TOKEN_URL, data=token_params, headers=token_headers)).json()
-            auth_header = {"Authorization": f"Bearer {auth_token['access_token']}"}
-            user = (await client.get(Discord.USER_URL, headers=auth_header)).json()
-            token, _ = await auth.reset_user_token(request.state.db_conn, user["id"])
+        token_params, token_headers = build_oauth_token_request(request.query_params["code"])
+        auth_token = (await client.post(Discord.TOKEN_URL, data=token_params, headers=token_headers)).json()
+        auth_header = {"Authorization": f"Bearer {auth_token['access_token']}"}
+        user = (await client.get(Discord.USER_URL, headers=auth_header)).json()
+        # The connection is only taken once Discord answered, rather than held idle during both calls
+        async with Connections.DB_POOL.acquire() as conn:
+            token, _ = await auth.reset_user_token(conn, user["id"])
     except KeyError:
         # Ensure that users don't land on the show_pixel page
         log.error(traceback.format_exc())
@@ -13,9 +13,35 @@ router = APIRouter(prefix="/canvas", tags=["Canvas Endpoints"])
 # We include this at the bottom
 secure = APIRouter(dependencies=[Depends(auth.JWTBearer())])
 
+# The canvas size is fixed for the lifetime of the process, so its response is serialised once at import time
+_SIZE_BODY = GetSize(width=Sizes.WIDTH, height=Sizes.HEIGHT).json().encode()
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Return whether an Accept-Encoding header allows a gzip response, taking `q=0` refusals into account."""
+    wildcard = False
+    for coding in accept_encoding.split(","):
+        name, *params = (part.strip() for part in coding.split(";"))
+        accepted = True
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    accepted = float(value) > 0
+                except ValueError:
+                    accepted = False
+
+        name = name.lower()
+        if name in ("gzip", "x-gzip"):
+            return accepted
+        elif name == "*":
+            wildcard = accepted
+
+    return wildcard
+
 
 @router.get("/size", response_model=GetSize)
-async def size() -> GetSize:
+async def size() -> Response:
     """
     Get the size of the Pixels canvas.
 
@@ -38,7 +64,7 @@ async def size() -> GetSize:
     print(f"We got our canvas size! Height: {canvas_height}, Width: {canvas_width}.")
     ```
     """
-    return GetSize(width=Sizes.WIDTH, height=Sizes.HEIGHT)
+    return Response(_SIZE_BODY, media_type="application/json")
 
 
 @secure.get("/pixels", response_class=Response, responses={
@@ -84,10 +110,28 @@ async def canvas_pixels(request: Request) -> Response:
     # have fun processing the returned data...
     ```
     """
-    return Response(
-        await request.state.canvas.get_pixels(),
-        media_type="application/octet-stream"
-    )
+    canvas = request.state.canvas
+    compress = _accepts_gzip(request.headers.get("accept-encoding", ""))
+    pixels = await (canvas.get_compressed_pixels() if compress else canvas.get_pixels())
+    # Without a board there is nothing to compress, the empty response is the same for every client
+    compress = compress and pixels is not None
+
+    # The board is served gzipped or not depending on the request, so caches must key it on Accept-Encoding
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+
+    # Clients polling the board only get it again once it has changed
+    if canvas.snapshot_version is not None:
+        # Each encoding is a different representation, so they don't share an ETag
+        suffix = "-gzip" if compress else ""
+        headers["ETag"] = f'W/"{canvas.snapshot_version}{suffix}"'
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            headers.pop("Content-Encoding", None)
+            return Response(status_code=304, headers=headers)
+
+    # The snapshots are immutable bytes, so they are sent as is without copying them
+    return Response(pixels, media_type="application/octet-stream", headers=headers)
 
 
 @secure.get("/pixel", response_model=Pixel)
@@ -133,7 +177,7 @@ async def get_pixel(x: int, y: int, request: Request) -> Pixel:
         raise HTTPException(400, "Pixel is out of the canvas bounds.")
     pixel_data = await request.state.canvas.get_pixel(x, y)
 
-    return Pixel(x=x, y=y, rgb=''.join(f"{x:02x}" for x in pixel_data))
+    return Pixel(x=x, y=y, rgb=pixel_data.hex())
 
 
 @secure.put("/pixel", response_model=Message)
@@ -142,7 +186,7 @@ async def get_pixel(x: int, y: int, request: Request) -> Pixel:
     time_unit=Ratelimits.PUT_PIXEL_RATE_LIMIT,
     cooldown=Ratelimits.PUT_PIXEL_RATE_COOLDOWN
 )
-async def put_pixel(request: Request, pixel: Pixel) -> Message:
+async def put_pixel(request: Request, pixel: Pixel) -> dict:
     """
     Override the pixel at the specified coordinate with the specified color.
 
@@ -180,6 +224,7 @@ async def put_pixel(request: Request, pixel: Pixel) -> Message:
     """
     log.info(f"{request.state.user_id} is setting {pixel.x}, {pixel.y} to {pixel.rgb}")
     await request.state.canvas.set_pixel(request.state.db_conn, pixel.x, pixel.y, pixel.rgb, request.state.user_id)
-    return Message(message=f"Set pixel at x={pixel.x},y={pixel.y} to color {pixel.rgb}.")
+    # A plain dict skips building a Message model only for it to be converted back with .dict()
+    return {"message": f"Set pixel at x={pixel.x},y={pixel.y} to color {pixel.rgb}."}
 
 router.include_router(secure)
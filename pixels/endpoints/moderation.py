@@ -4,7 +4,6 @@ import json
 import logging
 import typing as t
 from datetime import datetime
-from functools import partial
 
 from PIL import Image
 from asyncpg import Connection
@@ -22,11 +21,14 @@ router = APIRouter(
     dependencies=[Depends(auth.JWTBearer(is_mod_endpoint=True))]
 )
 
+# The mod check response never changes, so it is serialised once at import time
+_MOD_CHECK_BODY = Message(message="Hello fellow moderator!").json().encode()
+
 
 @router.get("/mod", response_model=Message)
-async def mod_check(request: Request) -> Message:
+async def mod_check(request: Request) -> Response:
     """Check if the authenticated user is a mod."""
-    return Message(message="Hello fellow moderator!")
+    return Response(_MOD_CHECK_BODY, media_type="application/json")
 
 
 @router.post("/set_mod", response_model=Message)
@@ -42,6 +44,7 @@ async def set_mod(request: Request, user: User) -> Message:
             return Message(message=f"User with user_id {user_id} is already a mod.")
 
         await conn.execute("UPDATE users SET is_mod = true WHERE user_id = $1", user_id)
+    await auth.auth_cache.invalidate_user(user_id)
     return Message(message=f"Successfully set user with user_id {user_id} to mod.")
 
 
@@ -51,16 +54,24 @@ async def ban_users(request: Request, user_list: list[User]) -> ModBan:
     conn: Connection = request.state.db_conn
     users = [user.user_id for user in user_list]
 
-    records = await conn.fetch("SELECT * FROM users WHERE user_id=any($1::bigint[])", tuple(users))
-    db_users = [record["user_id"] for record in records]
+    # Both updates run as a single statement, so banning is one round trip and atomic without a transaction.
+    # Ref:
+    # https://magicstack.github.io/asyncpg/current/faq.html#why-do-i-get-postgressyntaxerror-when-using-expression-in-1
+    sql = (
+        "WITH banned AS ("
+        "    UPDATE users SET is_banned=TRUE WHERE user_id=any($1::bigint[]) RETURNING user_id"
+        "), history AS ("
+        "    UPDATE pixel_history SET deleted=TRUE WHERE user_id IN (SELECT user_id FROM banned)"
+        ") "
+        "SELECT array_agg(user_id) FROM banned"
+    )
+    # array_agg gives NULL rather than an empty array when none of the users exist
+    db_users = await conn.fetchval(sql, users) or []
 
     non_db_users = set(users) - set(db_users)
 
-    async with conn.transaction():
-        # Ref:
-        # https://magicstack.github.io/asyncpg/current/faq.html#why-do-i-get-postgressyntaxerror-when-using-expression-in-1
-        await conn.execute("UPDATE users SET is_banned=TRUE WHERE user_id=any($1::bigint[])", db_users)
-        await conn.execute("UPDATE pixel_history SET deleted=TRUE WHERE user_id=any($1::bigint[])", db_users)
+    for user_id in db_users:
+        await auth.auth_cache.invalidate_user(user_id)
 
     await request.state.canvas.sync_cache(conn, skip_check=True)
 
@@ -88,6 +99,20 @@ async def pixel_history(
     return PixelHistory(user_id=record["user_id"])
 
 
+def _render_png(canvas: bytes) -> bytes:
+    """Render the canvas as a PNG at the webhook size, all in one go so it only needs a single executor hop."""
+    image = Image.frombytes("RGB", (Sizes.WIDTH, Sizes.HEIGHT), canvas)
+
+    # Increase size of image so that this looks better in Discord
+    image = image.resize(Sizes.WEBHOOK_SIZE, Image.NEAREST)
+
+    # BytesIO gives a file-like interface for saving
+    # and later this is able to get actual content that will be sent.
+    file = io.BytesIO()
+    image.save(file, format="PNG")
+    return file.getvalue()
+
+
 @router.post("/webhook", response_model=Message)
 async def webhook(request: Request) -> Message:
     """Send or update the Discord webhook image."""
@@ -112,63 +137,43 @@ async def webhook(request: Request) -> Message:
 
     # Run Pillow stuff in executor because these actions are blocking
     loop = asyncio.get_event_loop()
-    image = await loop.run_in_executor(
-        None,
-        partial(
-            Image.frombytes,
-            "RGB",
-            (Sizes.WIDTH, Sizes.HEIGHT),
-            await request.state.canvas.get_pixels()
-        )
-    )
-
-    # Increase size of image so that this looks better in Discord
-    image = await loop.run_in_executor(
-        None,
-        partial(
-            image.resize,
-            Sizes.WEBHOOK_SIZE,
-            Image.NEAREST
-        )
-    )
-
-    # BytesIO gives a file-like interface for saving
-    # and later this is able to get actual content that will be sent.
-    file = io.BytesIO()
-    await loop.run_in_executor(None, partial(image.save, file, format="PNG"))
+    image_data = await loop.run_in_executor(None, _render_png, await request.state.canvas.get_pixels())
 
     # Name file to pixels_TIMESTAMP.png
     files = {
-        "file": (f"pixels_{now.timestamp()}.png", file.getvalue(), "image/png")
+        "file": (f"pixels_{now.timestamp()}.png", image_data, "image/png")
     }
 
-    async with AsyncClient(timeout=None) as client:
-        # If the last message exists in cache, try to edit it
-        if last_message_id is not None:
-            data["attachments"] = []
-            edit_resp = await client.patch(
-                f"{Discord.WEBHOOK_URL}/messages/{int(last_message_id)}",
-                data={"payload_json": json.dumps(data)},
-                files=files
-            )
-
-            if edit_resp.status_code != 200:
-                log.warning(f"Non 200 status code from Discord: {edit_resp.status_code}\n{edit_resp.text}")
-                last_message_id = None
-
-        # If no message is found in cache, the message is missing or the edit failed, send a new message
-        if last_message_id is None:
-            # If we are sending a new message, don't specify attachments
-            data.pop("attachments", None)
-            # Username can only be set when sending a new message
-            data["username"] = "Pixels"
-            create_resp = (await client.post(
-                Discord.WEBHOOK_URL,
-                data={"payload_json": json.dumps(data)},
-                files=files
-            )).json()
-
-            await request.state.redis_pool.set("last-webhook-message", create_resp["id"])
+    client: AsyncClient = request.app.state.http_client
+
+    # If the last message exists in cache, try to edit it
+    if last_message_id is not None:
+        data["attachments"] = []
+        edit_resp = await client.patch(
+            f"{Discord.WEBHOOK_URL}/messages/{int(last_message_id)}",
+            data={"payload_json": json.dumps(data)},
+            files=files,
+            timeout=None
+        )
+
+        if edit_resp.status_code != 200:
+            log.warning(f"Non 200 status code from Discord: {edit_resp.status_code}\n{edit_resp.text}")
+            last_message_id = None
+
+    # If no message is found in cache, the message is missing or the edit failed, send a new message
+    if last_message_id is None:
+        # If we are sending a new message, don't specify attachments
+        data.pop("attachments", None)
+        # Username can only be set when sending a new message
+        data["username"] = "Pixels"
+        create_resp = (await client.post(
+            Discord.WEBHOOK_URL,
+            data={"payload_json": json.dumps(data)},
+            files=files,
+            timeout=None
+        )).json()
+
+        await request.state.redis_pool.set("last-webhook-message", create_resp["id"])
 
     return Message(message="Webhook posted successfully.")
 
@@ -1,41 +1,30 @@
 import enum
-import re
 import typing as t
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, Field, validator
 
 from pixels.constants import Sizes
 
-_RGB_RE = re.compile(r"[0-9a-fA-F]{6}")
-
 
 class Pixel(BaseModel):
     """A pixel as used by the api."""
 
-    x: int
-    y: int
+    # Bounds are declared as field constraints rather than validators, so they are checked
+    # by pydantic's compiled number validators and show up in the OpenAPI schema.
+    x: int = Field(..., ge=0, lt=Sizes.WIDTH)
+    y: int = Field(..., ge=0, lt=Sizes.HEIGHT)
     rgb: str
 
-    @validator("x")
-    def x_must_be_lt_width(cls, x: int) -> int:
-        """Ensure that x is within the bounds of the image."""
-        if 0 <= x < Sizes.WIDTH:
-            return x
-        else:
-            raise ValueError(f"x must be inside range(0, {Sizes.WIDTH})")
-
-    @validator("y")
-    def y_must_be_lt_height(cls, y: int) -> int:
-        """Ensure that y is within the bounds of the image."""
-        if 0 <= y < Sizes.HEIGHT:
-            return y
-        else:
-            raise ValueError(f"y must be inside range(0, {Sizes.HEIGHT})")
-
     @validator("rgb")
     def rgb_must_be_valid_hex(cls, rgb: str) -> str:
         """Ensure rgb is a 6 characters long hexadecimal string."""
-        if _RGB_RE.fullmatch(rgb):
+        # bytes.fromhex skips whitespace between pairs, so check both lengths rather than running a regex
+        try:
+            valid = len(rgb) == 6 and len(bytes.fromhex(rgb)) == 3
+        except ValueError:
+            valid = False
+
+        if valid:
             return rgb
         else:
             raise ValueError(
@@ -2,24 +2,27 @@ import logging
 import typing as t
 
 import aioredis
+import httpx
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.responses import RedirectResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from pixels.canvas import Canvas
 from pixels.constants import Connections, Server
 from pixels.endpoints import authorization, general, moderation
 from pixels.utils import ratelimits
+from pixels.utils.responses import GZipMiddleware, JSONResponse
 
 log = logging.getLogger(__name__)
 
 app = FastAPI(
     docs_url=None,
-    redoc_url=None
+    redoc_url=None,
+    default_response_class=JSONResponse
 )
 
 app.include_router(authorization.router)
@@ -33,6 +36,9 @@ app.add_middleware(
     allow_methods=["GET", "HEAD"],
     allow_headers=["*"],
 )
+# No JSON API route returns 1KB or more, so this compresses the OpenAPI schema served at /openapi.json,
+# the HTML docs pages and the stylesheet under /static. The canvas endpoint compresses its own responses.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 app.mount("/static", StaticFiles(directory="pixels/static"), name="static")
 
 
@@ -84,6 +90,12 @@ async def startup() -> None:
     await Connections.DB_POOL
 
     app.state.redis_pool = await aioredis.create_redis_pool(Connections.REDIS_URL)
+
+    # Shared by all requests to Discord so connections are kept alive between them
+    app.state.http_client = httpx.AsyncClient(
+        timeout=10,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
     Connections.REDIS_FUTURE.set_result(app.state.redis_pool)
 
     app.state.canvas = Canvas(app.state.redis_pool)
@@ -93,21 +105,73 @@ async def startup() -> None:
 @app.on_event("shutdown")
 async def shutdown() -> None:
     """Close down the app."""
-    app.state.rate_limit_cleaner.cancel()
     await Connections.DB_POOL.close()
+    await app.state.http_client.aclose()
 
 
-@app.middleware("http")
-async def setup_data(request: Request, callnext: t.Callable) -> Response:
-    """Get a connection from the pool and a canvas reference for this request."""
-    async with Connections.DB_POOL.acquire() as connection:
-        request.state.db_conn = connection
-        request.state.canvas = app.state.canvas
-        request.state.redis_pool = app.state.redis_pool
-        response = await callnext(request)
-    request.state.db_conn = None
-    request.state.canvas = None
-    return response
+class RequestStateMiddleware:
+    """
+    Get a connection from the pool and a canvas reference for each request.
+
+    This is a plain ASGI middleware rather than an `@app.middleware("http")` function, as those are run
+    through Starlette's BaseHTTPMiddleware, which spawns an extra task and memory streams for every request.
+    Values are stored in `scope["state"]`, which is what `request.state` reads from.
+
+    Routes which never touch the database don't get a connection, so they don't hold up pool slots.
+    Routes which only need the database to authenticate don't get one either, `JWTBearer` borrows
+    a connection itself on the rare auth cache miss.
+    """
+
+    NO_DB_PATHS = frozenset({
+        "/", "/docs", "/authorize", "/show_token", "/canvas/size", "/openapi.json",
+        # Acquires its own connection once it's done talking to Discord
+        "/callback",
+    })
+    NO_DB_PREFIXES = ("/static/",)
+    AUTH_ONLY_ROUTES = frozenset({
+        ("GET", "/canvas/pixels"),
+        ("GET", "/canvas/pixel"),
+        ("GET", "/mod"),
+        # Rate limit HEAD endpoints, named after the route they limit
+        ("HEAD", "/canvas_pixels"),
+        ("HEAD", "/get_pixel"),
+        ("HEAD", "/put_pixel"),
+    })
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Populate the request state and call the next app."""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        path = scope["path"]
+        if (
+            path in self.NO_DB_PATHS
+            or path.startswith(self.NO_DB_PREFIXES)
+            or (scope["method"], path) in self.AUTH_ONLY_ROUTES
+        ):
+            state["db_conn"] = None
+            state["canvas"] = app.state.canvas
+            state["redis_pool"] = app.state.redis_pool
+            await self.app(scope, receive, send)
+            return
+
+        async with Connections.DB_POOL.acquire() as connection:
+            state["db_conn"] = connection
+            state["canvas"] = app.state.canvas
+            state["redis_pool"] = app.state.redis_pool
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                state["db_conn"] = None
+                state["canvas"] = None
+
+
+app.add_middleware(RequestStateMiddleware)
 
 
 @app.get("/", include_in_schema=False)
@@ -1,17 +1,164 @@
+import base64
+import hashlib
+import hmac
+import json
 import logging
 import secrets
-from datetime import datetime, timedelta, timezone
+import typing as t
+from collections import OrderedDict, defaultdict
+from time import monotonic, time
 
+import orjson
 from asyncpg import Connection, Record
 from fastapi import HTTPException, Request
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 
-from pixels.constants import Authorization, Server
+from pixels.constants import Authorization, Connections, Server
 from pixels.models import AuthState
 
 log = logging.getLogger(__name__)
 
+_JWT_KEY = Server.JWT_SECRET.encode("utf-8")
+# The header segment of every token we issue, serialised the same way as jose does
+_HS256_HEADER_SEGMENT = base64.urlsafe_b64encode(
+    json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":"), sort_keys=True).encode("utf-8")
+).rstrip(b"=")
+
+
+def _b64decode(segment: bytes) -> bytes:
+    """Decode an unpadded base64url JWT segment."""
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+def decode_token(token: str) -> dict:
+    """
+    Verify the signature of an HS256 JWT and return its claims.
+
+    This is equivalent to `jose.jwt.decode` for the tokens we issue, but uses the C implementations
+    of hmac, base64 and orjson directly instead of going through jose's pure Python layers.
+    A `JWTError` is raised if the token is malformed or its signature doesn't match.
+    """
+    try:
+        signing_input, signature = token.encode("ascii").rsplit(b".", 1)
+        header_segment, payload_segment = signing_input.split(b".", 1)
+
+        # Our own tokens all share the same header, only foreign ones need to be parsed
+        if header_segment != _HS256_HEADER_SEGMENT:
+            header = orjson.loads(_b64decode(header_segment))
+            if not isinstance(header, dict) or header.get("alg") != "HS256":
+                raise JWTError("The specified alg value is not allowed")
+
+        expected = hmac.new(_JWT_KEY, signing_input, hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            raise JWTError("Signature verification failed.")
+
+        claims = orjson.loads(_b64decode(payload_segment))
+    except ValueError:
+        # Covers bad segment counts, invalid base64, non ascii tokens and invalid JSON
+        raise JWTError("Invalid token.")
+
+    if not isinstance(claims, dict):
+        raise JWTError("Invalid payload string: must be a json object")
+    return claims
+
+
+class AuthCache:
+    """
+    A per worker LRU cache of decoded access tokens and the matching user row.
+
+    Every authenticated request would otherwise decode its token and query the users table.
+    Tokens are stored as a blake2b digest so the cache never holds usable credentials. An entry lives
+    at most `ttl` seconds and never past the expiration of its token. Whenever the user's token, mod status
+    or ban status changes, a per user generation counter is bumped in redis. Entries remember the generation
+    they were cached at, so every worker drops them on their next use.
+    """
+
+    def __init__(self, max_size: int, ttl: float, failure_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+
+        # Kept in least recently used order, so the first key is always the next one to evict
+        self._entries: OrderedDict[bytes, tuple[float, int, t.Optional[bytes], dict, Record]] = OrderedDict()
+        self._user_tokens: defaultdict[int, set[bytes]] = defaultdict(set)
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        """Return the digest used to store `token`."""
+        return hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+    @staticmethod
+    def _generation_key(user_id: int) -> str:
+        """Return the redis key holding the generation of `user_id`."""
+        return f"auth-generation-{user_id}"
+
+    async def user_generation(self, user_id: int) -> t.Optional[bytes]:
+        """Return the current generation of `user_id`, to be read before fetching the user row."""
+        redis = await Connections.REDIS_FUTURE
+        return await redis.get(self._generation_key(user_id))
+
+    async def get(self, token: str) -> t.Optional[tuple[dict, Record]]:
+        """Return the cached token data and user row, or None if the token isn't cached or is outdated."""
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, user_id, generation, token_data, user_state = entry
+        if expires_at < monotonic() or generation != await self.user_generation(user_id):
+            # A concurrent request may have cached a fresh entry for this token while the generation was read
+            if self._entries.get(key) is entry:
+                self._remove(key, self._entries.pop(key))
+            return None
+
+        if self._entries.get(key) is entry:
+            self._entries.move_to_end(key)
+        return token_data, user_state
+
+    def set(self, token: str, token_data: dict, user_state: t.Optional[Record], generation: t.Optional[bytes]) -> None:
+        """Cache the decoded `token_data` and `user_state` of `token`, unless the user doesn't exist."""
+        if user_state is None:
+            return
+
+        ttl = self.failure_ttl if user_state["is_banned"] else self.ttl
+        ttl = min(ttl, float(token_data["expiration"]) - time())
+        if ttl <= 0:
+            return
+
+        key = self._key(token)
+        if key not in self._entries and len(self._entries) >= self.max_size:
+            self._remove(*self._entries.popitem(last=False))
+
+        user_id = int(token_data["id"])
+        self._entries[key] = (monotonic() + ttl, user_id, generation, token_data, user_state)
+        self._user_tokens[user_id].add(key)
+
+    async def invalidate_user(self, user_id: int) -> None:
+        """Drop every cached token belonging to `user_id`, in every worker."""
+        user_id = int(user_id)
+        for key in self._user_tokens.pop(user_id, ()):
+            self._entries.pop(key, None)
+
+        # The generation outlives any entry cached before the bump, so it can't go back to a value they hold
+        redis = await Connections.REDIS_FUTURE
+        pipe = redis.pipeline()
+        pipe.incr(self._generation_key(user_id))
+        pipe.expire(self._generation_key(user_id), int(self.ttl * 2))
+        await pipe.execute()
+
+    def _remove(self, key: bytes, entry: tuple[float, int, t.Optional[bytes], dict, Record]) -> None:
+        """Remove the reverse mapping of an entry which was popped from the cache."""
+        _, user_id, _, _, _ = entry
+        keys = self._user_tokens.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_tokens[user_id]
+
+
+auth_cache = AuthCache(Authorization.CACHE_MAX_SIZE, Authorization.CACHE_TTL, Authorization.CACHE_FAILURE_TTL)
+
 
 class JWTBearer(HTTPBearer):
     """Dependency for routes to enforce JWT auth."""
@@ -25,24 +172,28 @@ class JWTBearer(HTTPBearer):
         credentials: HTTPAuthorizationCredentials = await super().__call__(request)
         credentials = credentials.credentials
         if not credentials:
-            raise HTTPException(status_code=403, detail=AuthState.NO_TOKEN)
+            raise HTTPException(status_code=403, detail=AuthState.NO_TOKEN.value)
 
-        try:
-            token_data = jwt.decode(credentials, Server.JWT_SECRET)
-        except JWTError:
-            raise HTTPException(status_code=403, detail=AuthState.INVALID_TOKEN.value)
+        if (cached := await auth_cache.get(credentials)) is not None:
+            token_data, user_state = cached
+        else:
+            try:
+                token_data = decode_token(credentials)
+            except JWTError:
+                raise HTTPException(status_code=403, detail=AuthState.INVALID_TOKEN.value)
 
-        user_state = await request.state.db_conn.fetchrow(
-            "SELECT is_banned, is_mod, key_salt FROM users WHERE user_id = $1",
-            int(token_data["id"])
-        )
+            # Read before the row, so a change committed in between makes the entry outdated rather than stale
+            generation = await auth_cache.user_generation(int(token_data["id"]))
+            user_state = await self._fetch_user_state(request, int(token_data["id"]))
+            auth_cache.set(credentials, token_data, user_state, generation)
 
         # Handle bad scenarios
 
         if token_data["grant_type"] != "access_token":
             raise HTTPException(status_code=403, detail=AuthState.WRONG_TOKEN.value)
 
-        expired = int(token_data["expiration"]) < datetime.now(timezone.utc).timestamp()
+        # time() is already a UTC timestamp, without building an aware datetime on every request
+        expired = int(token_data["expiration"]) < time()
         if user_state is None or user_state["key_salt"] != token_data["salt"] or expired:
             raise HTTPException(status_code=403, detail=AuthState.INVALID_TOKEN.value)
         elif user_state["is_banned"]:
@@ -53,6 +204,15 @@ class JWTBearer(HTTPBearer):
         request.state.user_id = int(token_data["id"])
         return credentials
 
+    @staticmethod
+    async def _fetch_user_state(request: Request, user_id: int) -> t.Optional[Record]:
+        """Fetch the user row, borrowing a connection if the route was served without one."""
+        if (conn := request.state.db_conn) is not None:
+            return await conn.statements["user_state"].fetchrow(user_id)
+
+        async with Connections.DB_POOL.acquire() as conn:
+            return await conn.statements["user_state"].fetchrow(user_id)
+
 
 async def reset_user_token(conn: Connection, user_id: str) -> tuple[str, Record]:
     """
@@ -64,33 +224,25 @@ async def reset_user_token(conn: Connection, user_id: str) -> tuple[str, Record]
     access tokens. For most uses this can ignored.
     """
     # Returns None if the user doesn't exist and false if they aren't banned
-    is_banned = await conn.fetchval("SELECT is_banned FROM users WHERE user_id = $1", int(user_id))
+    is_banned = await conn.statements["is_banned"].fetchval(int(user_id))
     if is_banned:
         raise PermissionError
     # 22 character long string
     token_salt = secrets.token_urlsafe(16)
     is_mod = user_id in Server.MODS
 
-    row = await conn.fetchrow(
-        "INSERT INTO users (user_id, key_salt, is_mod) "
-        "VALUES ($1, $2, $3) "
-        "ON CONFLICT (user_id) DO UPDATE SET key_salt=$2 "
-        "RETURNING *",
-        int(user_id),
-        token_salt,
-        is_mod,
-    )
+    row = await conn.statements["upsert_user"].fetchrow(int(user_id), token_salt, is_mod)
+    await auth_cache.invalidate_user(user_id)
 
     # Refresh tokens don't expire automatically, but when a request to
     # renew an access token is made and this timestamp has passed the refresh
     # token will be reset. The new token is then returned for the user to
     # replace locally.
-    expiration = datetime.now(timezone.utc) + timedelta(seconds=Authorization.REFRESH_EXPIRES_IN)
     token = jwt.encode(
         {
             "id": user_id,
             "grant_type": "refresh_token",
-            "expiration": expiration.timestamp(),
+            "expiration": time() + Authorization.REFRESH_EXPIRES_IN,
             "salt": token_salt,
         },
         Server.JWT_SECRET,
@@ -111,7 +263,7 @@ async def generate_access_token(conn: Connection, refresh_token: str) -> tuple[s
     This function returns the new access token and a potentially new refresh token.
     """
     try:
-        token_data = jwt.decode(refresh_token, Server.JWT_SECRET)
+        token_data = decode_token(refresh_token)
     except JWTError:
         raise HTTPException(status_code=403, detail=AuthState.INVALID_TOKEN.value)
 
@@ -127,16 +279,15 @@ async def generate_access_token(conn: Connection, refresh_token: str) -> tuple[s
     elif row['key_salt'] != token_data["salt"]:
         raise HTTPException(status_code=403, detail=AuthState.INVALID_TOKEN.value)
 
-    if int(token_data["expiration"]) < datetime.now(timezone.utc).timestamp():
+    if int(token_data["expiration"]) < time():
         # Time to renew the refresh token
         refresh_token, row = await reset_user_token(conn, row['user_id'])
 
-    expiration = datetime.now(timezone.utc) + timedelta(seconds=Authorization.ACCESS_EXPIRES_IN)
     token = jwt.encode(
         {
             "id": token_data["id"],
             "grant_type": "access_token",
-            "expiration": expiration.timestamp(),
+            "expiration": time() + Authorization.ACCESS_EXPIRES_IN,
             "salt": row['key_salt']
         },
         Server.JWT_SECRET,
@@ -3,6 +3,41 @@ import logging
 import typing
 
 import asyncpg
+from asyncpg.prepared_stmt import PreparedStatement
+
+# Statements run on (nearly) every request, prepared once per pooled connection
+PREPARED_STATEMENTS = {
+    "user_state": "SELECT is_banned, is_mod, key_salt FROM users WHERE user_id = $1",
+    "is_banned": "SELECT is_banned FROM users WHERE user_id = $1",
+    "cache_state": "SELECT last_modified, last_synced FROM cache_state",
+    "mark_synced": "UPDATE cache_state SET last_synced = now()",
+    "upsert_user": (
+        "INSERT INTO users (user_id, key_salt, is_mod) "
+        "VALUES ($1, $2, $3) "
+        "ON CONFLICT (user_id) DO UPDATE SET key_salt=$2 "
+        "RETURNING *"
+    ),
+    "insert_pixel": (
+        "INSERT INTO pixel_history (x, y, rgb, user_id, deleted) "
+        "VALUES ($1, $2, $3, $4, false)"
+    ),
+}
+
+
+class PixelsConnection(asyncpg.Connection):
+    """An asyncpg connection holding the prepared statements from `PREPARED_STATEMENTS`."""
+
+    statements: dict[str, PreparedStatement]
+
+
+async def prepare_statements(conn: PixelsConnection) -> None:
+    """
+    Prepare all the hot path statements on a new pool connection.
+
+    This is passed as the `init` callback of the pool, so Postgres only parses and plans
+    these queries once per connection instead of once per request.
+    """
+    conn.statements = {name: await conn.prepare(sql) for name, sql in PREPARED_STATEMENTS.items()}
 
 
 async def periodic_task(
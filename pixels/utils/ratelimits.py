@@ -2,22 +2,23 @@ import asyncio
 import functools
 import hashlib
 import inspect
-import itertools
 import logging
 import typing
 import uuid
 from collections import namedtuple
+from contextvars import ContextVar
 from dataclasses import dataclass
 from time import time
 
 import fastapi
-from aioredis import Redis
+from aioredis import Redis, ReplyError
 from fastapi import APIRouter, Depends, requests
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import Response
 
 from pixels.constants import Connections
 from pixels.utils import auth
+from pixels.utils.responses import JSONResponse
 
 log = logging.getLogger(__name__)
 
@@ -29,7 +30,9 @@ class __BucketBase:
     The base class for all rate limit buckets.
 
     Descendents must at the very least implement logic for:
-        _record_interaction, _calculate_remaining_requests, _trigger_cooldown, _check_cooldown, _get_remaining_cooldown
+        _calculate_remaining_requests, _check_cooldown, _get_remaining_cooldown, _reset_time
+    As well as either _record_interaction and _trigger_cooldown, which are used by the default _increment,
+    or their own _increment.
 
     All other functions are designed to be as malleable as possible, but they can be modified as needed.
     Ideally, avoid changing the constructor, to provide the most consistent interface possible.
@@ -42,8 +45,6 @@ class __BucketBase:
         remaining_requests: typing.Optional[int]
         clean_up_tasks: typing.List[typing.Callable]
 
-    _STATE = typing.Dict[int, _StateVariables]
-
     class OnCooldown(BaseException):
         """An exception class to provide information on the current timeout."""
 
@@ -68,13 +69,11 @@ class __BucketBase:
         :param count_failed_requests: Whether to count 4xx return codes in the rate limit. Defaults to True.
         :param bypass: A function that can override the regular rate limit checks.
         """
-        # Instance management
-        self.request_id = itertools.count(0)
-        self.state: __BucketBase._STATE = {}
+        # Instance management, each request runs in its own context so it only ever sees its own state
+        self._state = ContextVar(f"bucket_state_{id(self)}")
 
         # Bucket Params
         self.ROUTE_NAME: typing.Optional[str] = None
-        self.ROUTES: list[str] = []
         self.BYPASS = bypass
 
         _limits_type = namedtuple("LIMITS", "requests, time_unit, cooldown")
@@ -84,17 +83,22 @@ class __BucketBase:
 
         self._post_init()
 
+    @property
+    def state(self) -> _StateVariables:
+        """The state of the request currently being handled."""
+        return self._state.get()
+
     def _post_init(self) -> None:
         """Helper that subclasses can use to avoid modifying init arguments."""
         return
 
-    async def _pre_call(self, _request_id: int, request: fastapi.Request, *args, **kwargs) -> None:
+    async def _pre_call(self, request: fastapi.Request, *args, **kwargs) -> None:
         """Helper that subclasses can use to modify the instance before the rate limiting is run."""
         return
 
-    async def _init_state(self, request_id: int, request: fastapi.Request) -> None:
+    async def _init_state(self, request: fastapi.Request) -> None:
         """Initialize the state for this request."""
-        self.state.update({request_id: self._StateVariables(remaining_requests=None, clean_up_tasks=[])})
+        self._state.set(self._StateVariables(remaining_requests=None, clean_up_tasks=[]))
 
     def __call__(self, *args):
         """Wrap the route in a custom caller, and pass it to the route manager."""
@@ -102,46 +106,43 @@ class __BucketBase:
         if not isinstance(route_callback, typing.Callable):
             raise Exception("First parameter of rate limiter must be a function.")
 
-        function_hash = hashlib.md5(inspect.getsource(route_callback).encode("utf8")).hexdigest()
-        if function_hash not in self.ROUTES:
-            self.ROUTES.append(function_hash)
-            self.ROUTE_NAME = "|".join(self.ROUTES)
+        # The qualified name is the same in every worker, and doesn't need the source file to be read and hashed.
+        # It is set once, so routes sharing a bucket all use the keys of the first one.
+        if self.ROUTE_NAME is None:
+            self.ROUTE_NAME = f"{route_callback.__module__}.{route_callback.__qualname__}"
 
         # Add an HEAD endpoint to get rate limit details
         @router.head("/" + route_callback.__name__, name=f"{route_callback.__name__} rate limit")
         async def head_endpoint(request: requests.Request) -> Response:
             response = Response()
 
-            request_id = next(self.request_id)
-            await self._pre_call(request_id, request)
-            await self._init_state(request_id, request)
+            await self._pre_call(request)
+            await self._init_state(request)
 
-            if await self._check_cooldown(request_id):
+            if await self._check_cooldown():
                 response.headers.append(
                     "Cooldown-Reset",
-                    str(await self._get_remaining_cooldown(request_id))
+                    str(await self._get_remaining_cooldown())
                 )
             else:
-                await self.add_headers(response, request_id)
+                await self.add_headers(response)
             return response
 
         # functools.wraps is used here to wrap the endpoint while maintaining the signature
         @functools.wraps(route_callback)
         async def caller(*_args, **_kwargs) -> typing.Union[JSONResponse, Response]:
             # Instantiate request attributes
-            request_id = next(self.request_id)
-
             request: fastapi.Request = _kwargs['request']
             response: typing.Optional[typing.Union[JSONResponse, Response]] = None
 
-            await self._pre_call(*_args, _request_id=request_id, **_kwargs)
-            await self._init_state(request_id, request)
+            await self._pre_call(*_args, **_kwargs)
+            await self._init_state(request)
 
             # Try to skip rate limit checks
             bypass = await self.BYPASS() if inspect.iscoroutinefunction(self.BYPASS) else self.BYPASS()
             if not bypass:
                 try:
-                    await self._increment(request_id)
+                    await self._increment()
 
                 except self.OnCooldown as e:
                     response = JSONResponse(
@@ -164,74 +165,72 @@ class __BucketBase:
 
                 if isinstance(result, Response):
                     response = result
+                elif type(result) is dict:
+                    # Routes build their plain dicts out of JSON types, jsonable_encoder would only copy them
+                    response = JSONResponse(content=result)
                 else:
                     clean_result = jsonable_encoder(result)
                     response = JSONResponse(content=clean_result)
 
-                await self.add_headers(response, request_id)
-
-            # Setup post interaction tasks
-            state = self.state[request_id]
+                await self.add_headers(response)
 
-            tasks = response.background or fastapi.BackgroundTasks()
+            # Setup post interaction tasks, most requests don't have any
+            if clean_up_tasks := self.state.clean_up_tasks:
+                tasks = response.background or fastapi.BackgroundTasks()
 
-            for task in state.clean_up_tasks:
-                tasks.add_task(task)
-            self.clean_up_tasks = []
+                for task in clean_up_tasks:
+                    tasks.add_task(task)
 
-            # Make sure to remove the request state after everything else has been run
-            tasks.add_task(functools.partial(self.state.pop, request_id))
-
-            response.background = tasks
+                response.background = tasks
             return response
 
         return caller
 
-    async def add_headers(self, response: Response, request_id: int) -> None:
+    async def add_headers(self, response: Response) -> None:
         """Add ratelimit headers to the provided request."""
-        remaining_requests = await self.get_remaining_requests(request_id)
-        request_reset = await self._reset_time(request_id)
+        remaining_requests = await self.get_remaining_requests()
+        request_reset = await self._reset_time()
 
         response.headers.append("Requests-Remaining", str(remaining_requests))
         response.headers.append("Requests-Limit", str(self.LIMITS.requests))
         response.headers.append("Requests-Period", str(self.LIMITS.time_unit))
         response.headers.append("Requests-Reset", str(request_reset)[:6])
 
-    async def _increment(self, request_id: int) -> None:
+    async def _increment(self) -> None:
         """Reduce remaining quota, and check if a cooldown is needed."""
-        if await self._check_cooldown(request_id):
-            raise self.OnCooldown(await self._get_remaining_cooldown(request_id))
+        if await self._check_cooldown():
+            raise self.OnCooldown(await self._get_remaining_cooldown())
 
-        await self._record_interaction(request_id)
+        await self._record_interaction()
 
-        if await self.get_remaining_requests(request_id) < 0:
-            await self._trigger_cooldown(request_id)
-            raise self.OnCooldown(await self._get_remaining_cooldown(request_id))
+        if await self.get_remaining_requests() < 0:
+            await self._trigger_cooldown()
+            raise self.OnCooldown(await self._get_remaining_cooldown())
         else:
             return
 
-    async def get_remaining_requests(self, request_id: int) -> int:
+    async def get_remaining_requests(self) -> int:
         """Return the number of remaining requests. Logic wrapper for _remaining_getter."""
-        state = self.state[request_id]
+        state = self.state
 
         # Skip call if it is already known for this request.
         if state.remaining_requests is None:
-            state.remaining_requests = await self._calculate_remaining_requests(request_id)
+            state.remaining_requests = await self._calculate_remaining_requests()
         return state.remaining_requests
 
-    async def _record_interaction(self, request_id: int) -> None:
+    async def _record_interaction(self) -> None:
         """Insert an interaction into the database."""
         raise NotImplementedError()
 
-    async def _calculate_remaining_requests(self, request_id: int) -> int:
+    async def _calculate_remaining_requests(self) -> int:
         """Calculate the number of remaining requests."""
         raise NotImplementedError()
 
-    async def _trigger_cooldown(self, request_id: int) -> None:
+    async def _trigger_cooldown(self) -> None:
         """Insert cooldown information into the database."""
         raise NotImplementedError()
 
-    async def _check_cooldown(self, request_id: int) -> bool:
+    async def _check_cooldown(self) -> bool:
         """
         Check the DB for a current cooldown, and check if it can be cleared.
 
@@ -239,11 +238,11 @@ class __BucketBase:
         """
         raise NotImplementedError()
 
-    async def _get_remaining_cooldown(self, request_id: int) -> int:
+    async def _get_remaining_cooldown(self) -> int:
         """Return the time, in seconds, until a cooldown ends."""
         raise NotImplementedError()
 
-    async def _reset_time(self, request_id: int) -> int:
+    async def _reset_time(self) -> int:
         """Return the time, in seconds, before getting every interaction back."""
         raise NotImplementedError()
 
@@ -256,68 +255,115 @@ class UserRedis(__BucketBase):
         remaining_requests: typing.Optional[int]
         clean_up_tasks: list[typing.Callable]
         user_id: int
-
-    state: dict[int, _StateVariables]
+        # Expiry of the oldest interaction, known once the interaction of this request was recorded
+        oldest_expiry: typing.Optional[float] = None
 
     redis: typing.Optional[Redis] = None
 
-    async def _pre_call(self, _request_id: int, request: fastapi.Request, *args, **kwargs) -> None:
+    # Runs the whole of `_increment` on the redis server, in a single round trip.
+    # KEYS: cooldown key, interaction key
+    # ARGV: now, expiry of the new interaction, time unit, allowed requests, cooldown, interaction id
+    # Returns {0, remaining requests, expiry of the oldest interaction}, {1, remaining cooldown}
+    # or {2, cooldown} if it was just triggered.
+    _INCREMENT_SCRIPT = """
+        local cooldown = redis.call('TTL', KEYS[1])
+        if cooldown ~= -2 then
+            return {1, cooldown}
+        end
+
+        redis.call('ZADD', KEYS[2], ARGV[2], ARGV[6])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+
+        local remaining = tonumber(ARGV[4]) - redis.call('ZCARD', KEYS[2])
+        if remaining < 0 then
+            redis.call('SET', KEYS[1], 1, 'EX', ARGV[5])
+            return {2, tonumber(ARGV[5])}
+        end
+        local oldest = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+        return {0, remaining, oldest[2]}
+    """
+    # Redis keeps every script it ran, so after the first call only this digest needs to be sent
+    _INCREMENT_SCRIPT_SHA = hashlib.sha1(_INCREMENT_SCRIPT.encode("utf8")).hexdigest()
+
+    async def _pre_call(self, request: fastapi.Request, *args, **kwargs) -> None:
         if not self.redis:
             try:
                 self.redis = await Connections.REDIS_FUTURE
             except asyncio.InvalidStateError:
                 raise ValueError("Redis connection isn't ready yet.")
 
-    async def _init_state(self, request_id: int, request: fastapi.Request) -> None:
-        self.state.update({
-            request_id: self._StateVariables(
-                remaining_requests=None, clean_up_tasks=[], user_id=request.state.user_id
-            )
-        })
+    async def _init_state(self, request: fastapi.Request) -> None:
+        self._state.set(
+            self._StateVariables(remaining_requests=None, clean_up_tasks=[], user_id=request.state.user_id)
+        )
 
-    async def _record_interaction(self, request_id: int) -> None:
-        key = f"interaction-{self.ROUTE_NAME}-{self.state[request_id].user_id}"
-        log.debug(f"Recorded interaction of user {self.state[request_id].user_id} on {self.ROUTE_NAME}.")
+    async def _increment(self) -> None:
+        state = self.state
+        now = time()
+
+        keys = [f"cooldown-{self.ROUTE_NAME}-{state.user_id}", f"interaction-{self.ROUTE_NAME}-{state.user_id}"]
+        args = [
+            now, now + self.LIMITS.time_unit, self.LIMITS.time_unit, self.LIMITS.requests, self.LIMITS.cooldown,
+            str(uuid.uuid4())
+        ]
+
+        try:
+            status, value, *oldest_expiry = await self.redis.evalsha(self._INCREMENT_SCRIPT_SHA, keys=keys, args=args)
+        except ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            # The script isn't cached yet (first call or redis restarted), EVAL caches it for the next calls
+            status, value, *oldest_expiry = await self.redis.eval(self._INCREMENT_SCRIPT, keys=keys, args=args)
+
+        if status == 2:
+            log.info(
+                f"Triggering cooldown for user {state.user_id} "
+                f"on {self.ROUTE_NAME} for {self.LIMITS.cooldown} seconds."
+            )
+        if status:
+            raise self.OnCooldown(value)
 
-        await self.redis.zadd(key, time() + self.LIMITS.time_unit, str(uuid.uuid4()))
-        await self.redis.expire(key, self.LIMITS.time_unit)
+        log.debug(f"Recorded interaction of user {state.user_id} on {self.ROUTE_NAME}, {value} remaining.")
+        # Both values needed by the headers come back with the script, add_headers doesn't query redis again
+        state.remaining_requests = value
+        state.oldest_expiry = float(oldest_expiry[0])
 
-    async def _calculate_remaining_requests(self, request_id: int) -> int:
-        key = f"interaction-{self.ROUTE_NAME}-{self.state[request_id].user_id}"
+    async def _calculate_remaining_requests(self) -> int:
+        key = f"interaction-{self.ROUTE_NAME}-{self.state.user_id}"
 
-        # Cleanup expired entries
-        await self.redis.zremrangebyscore(key, max=time())
-        remaining = self.LIMITS.requests - int(await self.redis.zcount(key) or 0)
+        # Cleanup expired entries and count the others in a single round trip
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, max=time())
+        pipe.zcount(key)
+        _, count = await pipe.execute()
+        remaining = self.LIMITS.requests - int(count or 0)
 
-        log.debug(f"Remaining interactions of user {self.state[request_id].user_id} on {self.ROUTE_NAME}: {remaining}.")
+        log.debug(f"Remaining interactions of user {self.state.user_id} on {self.ROUTE_NAME}: {remaining}.")
         return remaining
 
-    async def _trigger_cooldown(self, request_id: int) -> None:
-        key = f"cooldown-{self.ROUTE_NAME}-{self.state[request_id].user_id}"
-
-        log.info(
-            f"Triggering cooldown for user {self.state[request_id].user_id} "
-            f"on {self.ROUTE_NAME} for {self.LIMITS.cooldown} seconds."
-        )
-        await self.redis.set(key, 1, expire=self.LIMITS.cooldown)
-
-    async def _check_cooldown(self, request_id: int) -> bool:
-        key = f"cooldown-{self.ROUTE_NAME}-{self.state[request_id].user_id}"
+    async def _check_cooldown(self) -> bool:
+        key = f"cooldown-{self.ROUTE_NAME}-{self.state.user_id}"
 
         if await self.redis.get(key):
-            log.debug(f"User {self.state[request_id].user_id} is already on cooldown.")
+            log.debug(f"User {self.state.user_id} is already on cooldown.")
             return True
         return False
 
-    async def _get_remaining_cooldown(self, request_id: int) -> int:
-        key = f"cooldown-{self.ROUTE_NAME}-{self.state[request_id].user_id}"
+    async def _get_remaining_cooldown(self) -> int:
+        key = f"cooldown-{self.ROUTE_NAME}-{self.state.user_id}"
 
         return await self.redis.ttl(key)
 
-    async def _reset_time(self, request_id: int) -> int:
-        key = f"interaction-{self.ROUTE_NAME}-{self.state[request_id].user_id}"
+    async def _reset_time(self) -> int:
+        if self.state.oldest_expiry is not None:
+            return max(0, self.state.oldest_expiry - time())
+
+        key = f"interaction-{self.ROUTE_NAME}-{self.state.user_id}"
 
-        if not (newest_uuid := await self.redis.zrange(key, 0, 0)):
+        # Fetch the member along with its score instead of looking the score up in a second round trip
+        if not (newest := await self.redis.zrange(key, 0, 0, withscores=True)):
             return 0
 
-        return max(0, await self.redis.zscore(key, newest_uuid[0]) - time())
+        (_, expiry), = newest
+        return max(0, expiry - time())
@@ -0,0 +1,20 @@
+from fastapi import responses
+from fastapi.middleware import gzip
+from starlette.types import Receive, Scope, Send
+
+# orjson serialises several times faster than the stdlib json module.
+# Every JSON response of the app, including the rate limited routes and error handlers, goes through this class.
+JSONResponse = responses.ORJSONResponse
+
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """GZip middleware which leaves alone the routes that compress their own responses."""
+
+    PRECOMPRESSED_PATHS = frozenset({"/canvas/pixels"})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Pass precompressed routes straight through, compress the rest."""
+        if scope["type"] == "http" and scope["path"] in self.PRECOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
@@ -29,6 +29,11 @@ CREATE TABLE IF NOT EXISTS  public.pixel_history (
 
 ALTER TABLE public.pixel_history ADD CONSTRAINT pixel_history_fk FOREIGN KEY (user_id) REFERENCES users(user_id);
 
+-- Latest visible pixel at each position, used by the current_pixel view and the pixel history lookup
+CREATE INDEX IF NOT EXISTS pixel_history_current_idx
+    ON public.pixel_history (x, y, pixel_history_id DESC)
+    WHERE NOT deleted;
+
 CREATE OR REPLACE VIEW public.current_pixel
 AS SELECT PH.x,
           PH.y,